@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+Ahead-of-time compiled versions of the most common normalizer_fun and
+transformer_fun pair for character-level models:
+data_utils.normalize(txt, max_length=300, truncate_left=True, encoding=None)
+followed by data_utils.to_one_hot with the Zhang and LeCun vocab.
+
+Build the transforms_aot extension module, next to this file, with
+
+    python _transforms_aot.py
+
+which needs numba and a C compiler, but only once: batch_data then
+imports transforms_aot without numba's JIT compilation at startup, and
+falls back to the Python functions if it has not been built.
+'''
+import numpy as np
+from numba.pycc import CC
+
+import data_utils
+
+cc = CC('transforms_aot')
+
+DOCLENGTH = 300
+# defaults of data_utils.normalize
+MIN_LENGTH = 100
+PAD_BYTE = ord(' ')
+VOCAB_LUT = data_utils.zhang_lecun_vocab_lut
+
+
+@cc.export('normalize_trunc_left_300', 'i8(u1[:], u1[:])')
+def normalize_trunc_left_300(bytes_in, out_u8):
+    ''' Normalizes the bytes of a text into out_u8, which must hold
+    DOCLENGTH bytes: keeps the last DOCLENGTH bytes, lower cases them,
+    reverses them, and pads them out on the left with spaces
+
+    @Returns:
+        length of bytes_in, or -1 if the text is too short and
+        was rejected
+    '''
+    txt_len = bytes_in.shape[0]
+    if txt_len < MIN_LENGTH:
+        return -1
+    nr_kept = min(txt_len, DOCLENGTH)
+    nr_padded = DOCLENGTH - nr_kept
+    for i in range(nr_padded):
+        out_u8[i] = PAD_BYTE
+    for i in range(nr_kept):
+        c = bytes_in[txt_len - 1 - i]
+        # str.lower only changes ASCII capitals
+        if c >= 65 and c <= 90:
+            c += 32
+        out_u8[nr_padded + i] = c
+    return txt_len
+
+
+@cc.export('to_one_hot_67x300', 'void(u1[:, :], i1[:, :, :])')
+def to_one_hot_67x300(u8_in, out_i8):
+    ''' One-hot encodes a (batch, DOCLENGTH) array of text bytes into
+    the zeroed (batch, 67, DOCLENGTH) array out_i8 '''
+    for r in range(u8_in.shape[0]):
+        for c in range(DOCLENGTH):
+            idx = VOCAB_LUT[u8_in[r, c]]
+            if idx >= 0:
+                out_i8[r, idx, c] = 1
+
+
+if __name__ == "__main__":
+    cc.compile()
@@ -1,18 +1,45 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import atexit
+import hashlib
+import functools
 import logging
+import threading
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.util
+import Queue
 
 import numpy as np
 import h5py
 
 import data_utils
 
+# numba is optional; without it batches are one-hot encoded with
+# data_utils.to_one_hot_batch instead of fill_one_hot_batch
+try:
+    import numba
+    prange = numba.prange
+except ImportError:
+    numba = None
+    prange = range
+
+# compiled by running _transforms_aot.py; without it, records are
+# normalized and one-hot encoded by the Python and numba versions
+try:
+    import transforms_aot
+except ImportError:
+    transforms_aot = None
+
 
 def batch_data(data_loader, batch_size=128, normalizer_fun=None, 
                transformer_fun=None, flatten=True,
                max_records=None, balance_labels=False,
-               nlabels=None):
+               nlabels=None, prefetch=2, label_dtype=None,
+               num_workers=0):
     '''
     Batches data, doing all necessary preprocessing and
     normalization.
@@ -34,11 +61,21 @@ def batch_data(data_loader, batch_size=128, normalizer_fun=None,
             by data_loader as its input and returns a normalized
             version of it. The default implements some normalizations
             from Zhang and LeCun's character-level convolutional 
-            networks paper.
+            networks paper. Records are rejected if it returns None
+            or raises a DataException; returning None is cheaper
+            (see data_utils.normalize_or_none).
 
         transformer_fun -- transforms the output of normalizer_fun into a numpy array.
             Can be used to do one-hot encoding, embedding lookups, etc.
             Output can be any 2+-dimensional numpy array.
+            If this is data_utils.to_one_hot, records are kept as raw bytes
+            and one-hot encoded a whole batch at a time (as int8) instead,
+            by fill_one_hot_batch if numba is available or else by
+            data_utils.to_one_hot_batch. If normalizer_fun is also
+            functools.partial(data_utils.normalize, max_length=300,
+            truncate_left=True, encoding=None) (or the same partial of
+            data_utils.normalize_or_none), byte strings are normalized and
+            encoded by the compiled transforms_aot module, if it is built.
 
         flatten -- should all dimensions of the output of transformer_fun
             be flattened (collapsed to one dimension)? If true, the 
@@ -55,20 +92,64 @@ def batch_data(data_loader, batch_size=128, normalizer_fun=None,
 
         nlabels -- number of unique labels to be expected in the dataset,
             used only if balance_labels is True
+
+        prefetch -- if nonzero, batches are prepared in a background thread,
+            up to this many ahead of the consumer, so that reading and
+            transforming records overlaps with whatever the consumer
+            does with each batch. Set to 0 to batch in the calling thread
+
+        label_dtype -- if not None, the numpy dtype of the labels, which must
+            then be scalars. Otherwise the dtype is inferred from the first
+            label (and widened if later labels do not fit it)
+
+        num_workers -- if nonzero, records are normalized and transformed
+            in a pool of this many worker processes, sidestepping the GIL.
+            Workers are forked, so normalizer_fun and transformer_fun need
+            not be picklable, but records and transformed records are
+            pickled on their way to and from the workers
             
     @Returns:
         generator that yields 2-tuples of (data, label), where data
         and label are numpy arrays representing a batch of data,  
-        equally sized in the first dimension
+        equally sized in the first dimension.
+        The arrays are read-only views onto buffers that are reused
+        by later batches: a batch is only valid until the one after
+        next is requested, so copy it if it must be kept around
+        longer (writing it out to HDF5 right away, as split_data
+        does, needs no copy)
     '''
+    if prefetch:
+        # one buffer for each queued batch, on top of the one being
+        # filled and the two the consumer may still be looking at
+        return _prefetch(_batch_data(data_loader, batch_size, normalizer_fun,
+                                     transformer_fun, flatten, max_records,
+                                     balance_labels, nlabels, label_dtype,
+                                     num_workers, prefetch + 3),
+                         prefetch)
+    return _batch_data(data_loader, batch_size, normalizer_fun,
+                       transformer_fun, flatten, max_records,
+                       balance_labels, nlabels, label_dtype, num_workers, 2)
+
 
-    # for the balanced_labels case: store a hash of docs indexed by label
-    docs = {}
+def _batch_data(data_loader, batch_size, normalizer_fun, transformer_fun,
+                flatten, max_records, balance_labels, nlabels, label_dtype,
+                num_workers, nbuffers):
+    ''' Generator implementing batch_data, cycling through a pool of
+    nbuffers batch buffers. Options that do not change from record to
+    record are resolved here, once, and the records are then batched by
+    _unbalanced_batches or _balanced_batches '''
     if balance_labels:
         assert nlabels is not None
         assert batch_size % nlabels == 0
-    # for the unbalanced labels case: store tuples of doc, label
-    docs_labels = []
+    # pool of preallocated (batch_size, ...) arrays that records are written
+    # into by index; allocated lazily from the first record, then the
+    # pool slots are filled in turn so that the batch last yielded is
+    # left intact while the next one is assembled
+    docs_pool = [None] * nbuffers
+    labels_pool = [None] * nbuffers
+    # with batched one-hot encoding, docs_pool holds the raw bytes
+    # of each record and the encoded batches go here
+    one_hot_pool = [None] * nbuffers
 
     logger = logging.getLogger(__name__)
     logger.debug(data_loader)
@@ -79,82 +160,447 @@ def batch_data(data_loader, batch_size=128, normalizer_fun=None,
     if normalizer_fun is None:
         logger.debug("Default normalization")
         normalizer_fun = lambda x: x
+    batch_one_hot = transformer_fun is data_utils.to_one_hot
+    # local names for functions called on every record
+    if batch_one_hot:
+        if transforms_aot is not None and _is_aot_normalizer(normalizer_fun):
+            normalizer_fun = _aot_normalizer(normalizer_fun)
+        transformer_fun = _text_to_bytes
+        store_doc = _store_bytes
+    else:
+        store_doc = _store_record
+    if label_dtype is not None:
+        # known dtype: allocate label buffers up front and assign
+        # scalars without inspecting each one
+        labels_pool = [np.empty((batch_size, 1), label_dtype)
+                       for _ in range(nbuffers)]
+        store_label = _store_scalar
+    else:
+        store_label = _store_record
+
+    def finish_batch(pool_idx):
+        ''' Returns the filled pool slot pool_idx as a (data, label) batch '''
+        docs_np = docs_pool[pool_idx]
+        if batch_one_hot:
+            one_hot_pool[pool_idx] = _one_hot_batch(one_hot_pool[pool_idx], docs_np)
+            docs_np = one_hot_pool[pool_idx]
+        docs_np = _readonly_view(docs_np)
+        if flatten==True:
+            # transform to form (batch_size, w*h); flattening doc
+            docs_np = docs_np.reshape((batch_size,-1))
+        # labels come out in a separate (batch_size, 1) np array
+        labels_np = _readonly_view(labels_pool[pool_idx]).reshape((batch_size, -1))
+        return docs_np, labels_np
+
+    if max_records is not None and batch_size > max_records:
+        return
+    # transformation and normalization, in this process or in workers
+    if num_workers:
+        transformed_records = _transform_in_pool(data_loader, normalizer_fun,
+                                                 transformer_fun, num_workers)
+    else:
+        transformed_records = (_transform_record(record, normalizer_fun, transformer_fun)
+                               for record in data_loader)
+    # None marks a rejected record
+    accepted_records = itertools.ifilter(None, transformed_records)
+    if balance_labels:
+        batches = _balanced_batches(accepted_records, batch_size, nlabels,
+                                    docs_pool, labels_pool, store_doc,
+                                    store_label, label_dtype, finish_batch)
+    else:
+        batches = _unbalanced_batches(accepted_records, batch_size,
+                                      docs_pool, labels_pool, store_doc,
+                                      store_label, finish_batch)
 
-    # loop over data, applying transforming fns,
-    # accumulating records into batches,
-    # and yielding them when batch size is reached
     nr_yielded = 0
-    for doc_text, label in data_loader:
-        # transformation and normalization
+    for docs_np, labels_np in batches:
+        nr_yielded += batch_size
+
+        logger.debug("Nr Yielded: {}, Max: {}".format(
+            nr_yielded, max_records))
+        logger.debug("Batch shape (docs): {}".format(docs_np.shape))
+
+        yield docs_np, labels_np
+        # stop before reading records for a batch that would
+        # go over max_records
+        if max_records is not None and nr_yielded + batch_size > max_records:
+            return
+
+
+def _unbalanced_batches(records, batch_size, docs_pool, labels_pool,
+                        store_doc, store_label, finish_batch):
+    ''' Writes (data, label) records into the pool slots in turn,
+    yielding finish_batch of each slot as soon as it is full '''
+    nbuffers = len(docs_pool)
+    pool_idx = 0
+    fill_idx = 0
+    for transformed_doc, label in records:
+        docs_pool[pool_idx] = store_doc(docs_pool[pool_idx],
+            fill_idx, transformed_doc, batch_size)
+        labels_pool[pool_idx] = store_label(labels_pool[pool_idx],
+            fill_idx, label, batch_size)
+        fill_idx += 1
+        # dispatch once batch is of appropriate size
+        if fill_idx == batch_size:
+            yield finish_batch(pool_idx)
+            # the next batch goes into the next buffer in the pool
+            pool_idx = (pool_idx + 1) % nbuffers
+            fill_idx = 0
+
+
+def _balanced_batches(records, batch_size, nlabels, docs_pool, labels_pool,
+                      store_doc, store_label, label_dtype, finish_batch):
+    ''' Like _unbalanced_batches, but fills each batch with batch_size / nlabels
+    records of every label, interleaved in sorted label order. Each label's
+    records are collected in its own (batch_size / nlabels, ...) store, and
+    records that arrive while that store is full are queued for later
+    batches '''
+    logger = logging.getLogger(__name__)
+    nbuffers = len(docs_pool)
+    pool_idx = 0
+    quota = batch_size // nlabels
+    # per label: stores of docs and labels, how many of their rows are
+    # filled, and the records waiting for a row to free up
+    doc_stores = {}
+    label_stores = {}
+    counts = {}
+    queued_docs = {}
+    # how many labels have a full store
+    n_ready_labels = 0
+    # labels in dispatch order, updated whenever a new label turns up
+    sorted_unique_labels = []
+    for transformed_doc, label in records:
         try:
-            #logger.debug("Normalization........")
-            doc_text = normalizer_fun(doc_text)
-            # transform document into a numpy array
-            transformed_doc = transformer_fun(doc_text)
-            # add to the appropriate queue of labeled docs
-            if balance_labels:
-                try:
-                    docs[label].append(transformed_doc)
-                except KeyError as e:
-                    docs[label] = [transformed_doc]
-            else:
-                docs_labels.append((transformed_doc, label))
-        except data_utils.DataException as e:
-            # text is rejected for being too short, or its rating is not usable, etc
-            #logger.debug("Type of input: {}".format(type(doc_text)))
-            #logger.debug("{}: {}".format(type(e), e))
-            pass
-
-        # dispatch once batch is of appropriate size 
-        if (balance_labels and 
-                all(len(docs[doc_subset]) >= batch_size/nlabels for doc_subset in docs) and
-                len(docs) == nlabels) or \
-            (balance_labels == False and len(docs_labels) >= batch_size):
-            # proceed in turn through documents of each label
-            # popping off until batch_size is reached
-            batched_docs = []
-            batched_labels = []
-            cur_label_idx = 0
-            if balance_labels:
-                sorted_unique_labels = sorted(docs.keys())
-                logger.debug("Accumulated records: {}".format({a: len(docs[a]) for a in docs}))
-            # main accumulation loop
-            while(len(batched_docs) < batch_size):
-                if max_records is not None and nr_yielded + batch_size > max_records:
+            count = counts[label]
+        except KeyError as e:
+            count = counts[label] = 0
+            doc_stores[label] = None
+            label_stores[label] = None if label_dtype is None else \
+                np.empty((quota, 1), label_dtype)
+            queued_docs[label] = collections.deque()
+            sorted_unique_labels = sorted(counts.keys())
+        if count == quota:
+            queued_docs[label].append(transformed_doc)
+            continue
+        doc_stores[label] = store_doc(doc_stores[label], count, transformed_doc, quota)
+        label_stores[label] = store_label(label_stores[label], count, label, quota)
+        counts[label] = count + 1
+        if count + 1 == quota:
+            n_ready_labels += 1
+
+        # dispatch once every label has a full store
+        while n_ready_labels == nlabels == len(counts):
+            logger.debug("Accumulated records: {}".format(
+                {a: counts[a] + len(queued_docs[a]) for a in counts}))
+            # label i goes into rows i, i + nlabels, i + 2 * nlabels...
+            for i, next_label in enumerate(sorted_unique_labels):
+                docs_pool[pool_idx] = _store_strided(docs_pool[pool_idx],
+                    i, nlabels, doc_stores[next_label], batch_size)
+                labels_pool[pool_idx] = _store_strided(labels_pool[pool_idx],
+                    i, nlabels, label_stores[next_label], batch_size)
+            yield finish_batch(pool_idx)
+            # the next batch goes into the next buffer in the pool
+            pool_idx = (pool_idx + 1) % nbuffers
+            # refill the stores from the queues
+            n_ready_labels = 0
+            for next_label in sorted_unique_labels:
+                label_queue = queued_docs[next_label]
+                count = 0
+                while label_queue and count < quota:
+                    doc_stores[next_label] = store_doc(doc_stores[next_label],
+                        count, label_queue.popleft(), quota)
+                    label_stores[next_label] = store_label(label_stores[next_label],
+                        count, next_label, quota)
+                    count += 1
+                counts[next_label] = count
+                if count == quota:
+                    n_ready_labels += 1
+
+
+def _transform_record(record, normalizer_fun, transformer_fun):
+    ''' Normalizes and transforms a single (data, label) record
+
+    @Returns:
+        (transformed data, label), or None if the record is rejected
+    '''
+    doc_text, label = record
+    try:
+        #logger.debug("Normalization........")
+        doc_text = normalizer_fun(doc_text)
+        # a None from the normalizer rejects the record without the
+        # cost of raising an exception
+        if doc_text is None:
+            return None
+        # transform document into a numpy array
+        return transformer_fun(doc_text), label
+    except data_utils.DataException as e:
+        # text is rejected for being too short, or its rating is not usable, etc
+        #logger.debug("Type of input: {}".format(type(doc_text)))
+        #logger.debug("{}: {}".format(type(e), e))
+        return None
+
+
+# normalizer_fun and transformer_fun of a _transform_in_pool worker process
+_worker_funs = None
+
+def _init_worker(normalizer_fun, transformer_fun):
+    global _worker_funs
+    _worker_funs = (normalizer_fun, transformer_fun)
+
+def _transform_chunk(records):
+    return [_transform_record(record, *_worker_funs) for record in records]
+
+def _detach_record(record):
+    ''' Copies the array (data, label) members of record, which may be
+    views into buffers that their iterator reuses (e.g. H5Iterator's) '''
+    doc, label = record
+    if isinstance(doc, np.ndarray):
+        doc = np.array(doc)
+    if isinstance(label, np.ndarray):
+        label = np.array(label)
+    return doc, label
+
+def _transform_in_pool(records, normalizer_fun, transformer_fun, num_workers,
+                       chunksize=64):
+    ''' Yields _transform_record results for records, in order, computed by
+    a pool of num_workers processes. Records are sent to the workers
+    chunksize at a time, with a couple of chunks per worker in flight, so
+    that records are not read too far ahead of the consumer. The pool is
+    shut down when this generator is closed or garbage collected.
+    Records are pickled for the workers some time after they are read,
+    so array records are copied first.
+    '''
+    pool = multiprocessing.Pool(num_workers, _init_worker,
+                                (normalizer_fun, transformer_fun))
+    records = iter(records)
+    pending = collections.deque()
+    try:
+        while True:
+            chunk = [_detach_record(record)
+                     for record in itertools.islice(records, chunksize)]
+            if chunk:
+                pending.append(pool.apply_async(_transform_chunk, (chunk,)))
+            if len(pending) >= 2 * num_workers or (pending and not chunk):
+                for transformed_record in pending.popleft().get():
+                    yield transformed_record
+            elif not chunk:
+                return
+    finally:
+        pool.terminate()
+
+
+# (stop event, thread) of each _prefetch producer that has not finished,
+# including those whose consumer has gone away but which are still
+# winding down
+_producers = set()
+
+def _stop_producers(timeout=5.0):
+    ''' Stops the _prefetch producer threads, waiting up to timeout seconds
+    for each to finish, so that they are not still running while the
+    interpreter shuts down '''
+    producers = list(_producers)
+    for stop, producer in producers:
+        stop.set()
+    for stop, producer in producers:
+        producer.join(timeout)
+
+def _prefetch(batches, prefetch):
+    ''' Runs the generator batches in a background thread, keeping up to
+    prefetch of its items queued ahead of the consumer. Exceptions raised
+    by batches are re-raised in the consumer; the thread stops once the
+    returned generator is closed or garbage collected, or at exit.
+    '''
+    # items are 2-tuples (batch, exc_info); (None, None) marks the end
+    batch_queue = Queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    # module globals may already be torn down if a producer outlives
+    # _stop_producers at exit, so the thread only uses locals
+    def put(item, Full=Queue.Full):
+        # wait for a free slot, giving up if the consumer has gone away
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce(exc_info=sys.exc_info, producers=_producers):
+        try:
+            for batch in batches:
+                if not put((batch, None)):
                     return
-                try:
-                    if balance_labels:
-                        # find which label to pop a document off for
-                        next_label = sorted_unique_labels[cur_label_idx]
-                        next_doc = docs[cur_label_idx].pop(0)
-                    else:
-                        next_doc, next_label = docs_labels.pop(0)
-                    batched_docs.append(next_doc)
-                    batched_labels.append(next_label)
-                    #logger.debug("Label: {}, Length: {}".format(next_label, len(batched_docs)))
-                except IndexError as e:
-                    # catch only when one of the lists in docs is empty
-                    if e.message != 'pop from empty list':
-                        raise
-                finally:
-                    # increment label index and wrap around if necessary
-                    # only needed if balance_labels is True, but harmless if not
-                    cur_label_idx += 1
-                    if cur_label_idx == nlabels:
-                        cur_label_idx = 0
-            docs_np = np.array(batched_docs)
-            if flatten==True:
-                # transform to form (batch_size, w*h); flattening doc
-                docs_np = docs_np.reshape((batch_size,-1))
-            # labels come out in a separate (batch_size, 1) np array
-            labels_np = np.array(batched_labels).reshape((batch_size, -1))
-            nr_yielded += batch_size
-
-            logger.debug("Nr Yielded: {}, Max: {}".format(
-                nr_yielded, max_records))
-            logger.debug("Batch shape (docs): {}".format(docs_np.shape))
-
-            yield docs_np, labels_np
+        except Exception:
+            put((None, exc_info()))
+        else:
+            put((None, None))
+        finally:
+            # release what batches holds (e.g. a worker pool) now, from
+            # this thread, rather than whenever it is garbage collected
+            batches.close()
+            producers.discard(producer_entry)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer_entry = (stop, producer)
+    _producers.add(producer_entry)
+    producer.start()
+    try:
+        while True:
+            # wait with a timeout, since an untimed get cannot be
+            # interrupted (e.g. by Ctrl-C) on python 2
+            try:
+                batch, exc_info = batch_queue.get(timeout=0.1)
+            except Queue.Empty:
+                if not producer.is_alive() and batch_queue.empty():
+                    raise RuntimeError("Prefetch thread stopped without finishing")
+                continue
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if batch is None:
+                return
+            yield batch
+    finally:
+        stop.set()
+
+
+def _store_record(buf, idx, record, batch_size):
+    ''' Writes record into row idx of buf, a (batch_size, ...) array
+    shaped and typed like record. buf is allocated if None, and its
+    dtype is widened if record cannot be cast to it safely (e.g. a string
+    longer than any seen so far), as np.array would do for a list.
+
+    @Returns:
+        buf, or its replacement if it had to be allocated or widened
+    '''
+    record = np.asarray(record)
+    if buf is None:
+        buf = np.empty((batch_size,) + record.shape, record.dtype)
+    elif not np.can_cast(record.dtype, buf.dtype):
+        buf = buf.astype(np.promote_types(buf.dtype, record.dtype))
+    buf[idx] = record
+    return buf
+
+
+def _store_strided(buf, start, step, rows, batch_size):
+    ''' Like _store_record, but writes the rows of the array rows into
+    rows start, start + step, start + 2 * step... of buf '''
+    if buf is None:
+        buf = np.empty((batch_size,) + rows.shape[1:], rows.dtype)
+    elif not np.can_cast(rows.dtype, buf.dtype):
+        buf = buf.astype(np.promote_types(buf.dtype, rows.dtype))
+    buf[start::step] = rows
+    return buf
+
+
+def _is_aot_normalizer(normalizer_fun):
+    ''' Is normalizer_fun the normalization that transforms_aot's
+    normalize_trunc_left_300 implements? '''
+    if not isinstance(normalizer_fun, functools.partial) or normalizer_fun.args or \
+            normalizer_fun.func not in (data_utils.normalize, data_utils.normalize_or_none):
+        return False
+    keywords = dict(normalizer_fun.keywords or {})
+    keywords.pop('none_if_rejected', None)
+    return keywords == {'max_length': 300, 'truncate_left': True, 'encoding': None}
+
+def _aot_normalizer(normalizer_fun):
+    ''' Returns a function normalizing byte strings like normalizer_fun,
+    with transforms_aot, into uint8 arrays ready for _store_bytes.
+    Rejected texts come out as None; unicode texts are left to
+    normalizer_fun '''
+    normalize_trunc_left_300 = transforms_aot.normalize_trunc_left_300
+    def aot_normalize(txt):
+        if not isinstance(txt, str):
+            return normalizer_fun(txt)
+        out = np.empty(300, np.uint8)
+        if normalize_trunc_left_300(np.frombuffer(txt, dtype=np.uint8), out) < 0:
+            return None
+        return out
+    return aot_normalize
+
+def _text_to_bytes(txt):
+    ''' Returns txt as a uint8 array of its bytes, for batched one-hot
+    encoding. Unicode characters beyond one byte are mapped to 0,
+    which is out of vocabulary, so that positions are preserved.
+    Arrays (from _aot_normalizer) are taken to be bytes already '''
+    if isinstance(txt, np.ndarray):
+        return txt
+    if isinstance(txt, unicode):
+        codes = np.frombuffer(txt.encode('utf-32-le'), dtype=np.uint32)
+        return np.where(codes < 256, codes, 0).astype(np.uint8)
+    return np.frombuffer(txt, dtype=np.uint8)
+
+
+def _store_bytes(buf, idx, record, batch_size):
+    ''' Like _store_record, but writes a uint8 array of text bytes into
+    row idx of a (batch_size, doclength) buffer, zero-padding records
+    shorter than the first one seen '''
+    if buf is None:
+        buf = np.empty((batch_size, record.shape[0]), np.uint8)
+    if record.shape[0] > buf.shape[1]:
+        raise ValueError("Record length {} exceeds batch document length {}".format(
+            record.shape[0], buf.shape[1]))
+    buf[idx, :record.shape[0]] = record
+    buf[idx, record.shape[0]:] = 0
+    return buf
+
+
+def fill_one_hot_batch(out, byte_rows, char_to_idx):
+    ''' One-hot encodes a batch of texts in place.
+
+    @Arguments:
+        out -- zeroed int8 array of shape (batch, vocab size, doclength)
+        byte_rows -- uint8 array of shape (batch, doclength) with the
+            bytes of each text, zero-padded
+        char_to_idx -- 256-entry array mapping each byte to its vocab
+            index, or -1 if out of vocab
+    '''
+    for r in prange(byte_rows.shape[0]):
+        for c in range(byte_rows.shape[1]):
+            idx = char_to_idx[byte_rows[r, c]]
+            if idx >= 0:
+                out[r, idx, c] = 1
+
+if numba is not None:
+    fill_one_hot_batch = numba.njit(cache=True, parallel=True)(fill_one_hot_batch)
+
+
+def _one_hot_batch(out, byte_rows):
+    ''' One-hot encodes byte_rows with the Zhang and LeCun vocab into out,
+    allocating it if it is None
+
+    @Returns:
+        out, or its replacement if it had to be allocated
+    '''
+    vocab_size = len(data_utils.zhang_lecun_vocab)
+    shape = (byte_rows.shape[0], vocab_size, byte_rows.shape[1])
+    if out is None or out.shape != shape:
+        out = np.zeros(shape, np.int8)
+    else:
+        out.fill(0)
+    if transforms_aot is not None and shape[1:] == (67, 300):
+        transforms_aot.to_one_hot_67x300(byte_rows, out)
+    elif numba is not None:
+        fill_one_hot_batch(out, byte_rows, data_utils.zhang_lecun_vocab_lut)
+    else:
+        data_utils.to_one_hot_batch(byte_rows, out=out)
+    return out
+
+
+def _store_scalar(buf, idx, value, batch_size):
+    ''' Like _store_record, for scalars going into a preallocated
+    (batch_size, 1) buffer of known dtype '''
+    buf[idx, 0] = value
+    return buf
+
+
+def _readonly_view(buf):
+    ''' Returns a view of buf that cannot be written through, so that
+    consumers of a pooled batch buffer do not modify it by accident '''
+    view = buf.view()
+    view.setflags(write=False)
+    return view
 
 
 class BatchIterator:
@@ -233,13 +679,72 @@ class DataIterator:
     def next(self):
         return self.data_iterator.next()
 
+# open h5py.File handles, keyed by (absolute path, mode), shared by
+# H5Iterators and split_data so that each file is only opened once
+_h5_cache = {}
+
+def _open_h5(path, mode='r'):
+    ''' Returns an open h5py.File for path, reusing the cached
+    handle if there is one. Cached handles must not be closed by
+    their users; see close_h5_files '''
+    key = (os.path.abspath(path), mode)
+    h5_file = _h5_cache.get(key)
+    if h5_file is None or not h5_file.id.valid:
+        h5_file = _h5_cache[key] = h5py.File(path, mode)
+    return h5_file
+
+def close_h5_files(path=None):
+    ''' Closes the cached HDF5 file handles for path, or all of them if
+    path is None. H5Iterators over those files can no longer be read.
+    Called at exit, and by split_data before it overwrites a file '''
+    for key in list(_h5_cache):
+        if path is None or key[0] == os.path.abspath(path):
+            _h5_cache.pop(key).close()
+
+atexit.register(close_h5_files)
+# handlers run last in, first out: stop producers, which may be reading
+# HDF5 files or waiting on worker pools, before the files are closed and
+# before multiprocessing.util's handler (registered on import) stops
+# the pools' processes
+atexit.register(_stop_producers)
+
+# records wider than this many bytes are read from HDF5 one contiguous
+# run of rows at a time, because a single selection of many scattered
+# wide rows is read much more slowly than the same rows as slices
+_MAX_SELECTION_ROW_NBYTES = 4096
+
+def _read_sorted_rows(dset, buf, sorted_rows):
+    ''' Reads the rows of dset at the increasing indices sorted_rows into
+    the first len(sorted_rows) rows of buf '''
+    row_nbytes = dset.dtype.itemsize * int(np.prod(dset.shape[1:]))
+    if row_nbytes <= _MAX_SELECTION_ROW_NBYTES:
+        dset.read_direct(buf, np.s_[sorted_rows], np.s_[:len(sorted_rows)])
+        return
+    run_bounds = [0] + (np.flatnonzero(np.diff(sorted_rows) != 1) + 1).tolist() + \
+        [len(sorted_rows)]
+    for run_start, run_end in zip(run_bounds[:-1], run_bounds[1:]):
+        first_row = int(sorted_rows[run_start])
+        dset.read_direct(buf, np.s_[first_row:first_row + run_end - run_start],
+                         np.s_[run_start:run_end])
+
 class H5Iterator:
     """Small utility class for iterating over an HDF5 file.
     Iterating over it yields tuples of (data, label) from datasets in the
     file with the names given in data_name and labels_name.
     By default, will randomly access records in any given iteration.
+    Records are read from the file block_size at a time.
+    Blocks are read into buffers that are reused for the whole iteration,
+    so records that are not singletons are views that only stay valid
+    until the next block is read (i.e., for block_size records); copy
+    them if they must be kept longer. batch_data copies each record
+    into its batch right away.
+    Indices are shuffled in place at the start of each iteration, so
+    only one iteration over an H5Iterator should be in progress at a time.
+    The file handle is shared with other H5Iterators over the same file,
+    and stays open until close is called or the interpreter exits.
     """    
-    def __init__(self, h5_path, data_name, labels_name, shuffle=True):
+    def __init__(self, h5_path, data_name, labels_name, shuffle=True,
+                 block_size=1024):
         """
         Arguments:
             h5_path -- path to HDF5 file to be accessed. This file should have the structure:
@@ -255,81 +760,119 @@ class H5Iterator:
 
             shuffle -- should numpy randomly shuffle the indices each time an iterator is 
                 made from this container?
+
+            block_size -- how many records to read from the file at once. Each
+                block of (shuffled) indices is read in sorted order, as a
+                single HDF5 selection or, for records wider than
+                _MAX_SELECTION_ROW_NBYTES, as slices of consecutive records,
+                then yielded in the original order
         """
-        self.h5file = h5py.File(h5_path, "r")
+        self.h5_path = h5_path
+        self.h5file = _open_h5(h5_path)
         self.shuffle = shuffle
+        self.block_size = block_size
         self.data = self.h5file[data_name]
         self.labels = self.h5file[labels_name]
 
-        self.indices = range(self.data.shape[0])
+        # record indices, shuffled in place by each shuffled iteration
+        index_dtype = np.int32 if self.data.shape[0] <= np.iinfo(np.int32).max else np.int64
+        self.indices = np.arange(self.data.shape[0], dtype=index_dtype)
         
-    def __del__(self):
-        self.h5file.close()
+    def close(self):
+        """Closes the HDF5 file, for this and every other H5Iterator over it"""
+        close_h5_files(self.h5_path)
     
     def __iter__(self):
         logger = logging.getLogger(__name__)
+        indices = self.indices
         if self.shuffle == True:
-            indices = np.random.permutation(self.indices)
-        else:
-            indices = self.indices
-
-        for which_index in indices:
-            # Singletons should be taken out of containers by default,
-            # to match the behavior of the nnn.load_data class of functions
-            # this presumes the data in the container is a string
-            next_data = self.data[which_index]
-            if next_data.shape == (1,):
-                next_data = bytes(next_data[0])
-                #logger.debug("Going from singleton to string: '{}...'".format(next_data[::-1][:50]))
-            else:
-                #logger.debug("H5 record shape: {}".format(next_data.shape))
-                pass
+            np.random.shuffle(indices)
 
-            # take label out of container if singleton
-            next_label = self.labels[which_index]
-            if next_label.shape == (1,):
-                next_label = next_label[0]
-                #logger.debug("Going from singleton to numeric type: {}".format(type(next_label)))
-                #logger.debug("Shape: {}".format(next_label.shape))
-            else:
-                #logger.debug("H5 record shape: {}".format(next_label.shape))
-                pass
-            yield (next_data, next_label)
+        # reusable buffers that each block is read directly into
+        data_buf = np.empty((self.block_size,) + self.data.shape[1:], self.data.dtype)
+        labels_buf = np.empty((self.block_size,) + self.labels.shape[1:], self.labels.dtype)
+        for block_start in range(0, len(indices), self.block_size):
+            block = indices[block_start:block_start + self.block_size]
+            # HDF5 selections must be increasing, so read the block sorted
+            # and keep track of where each requested record ended up
+            order = np.argsort(block)
+            sorted_block = block[order]
+            _read_sorted_rows(self.data, data_buf, sorted_block)
+            _read_sorted_rows(self.labels, labels_buf, sorted_block)
+
+            for block_pos in np.argsort(order):
+                # Singletons should be taken out of containers by default,
+                # to match the behavior of the nnn.load_data class of functions
+                # this presumes the data in the container is a string
+                next_data = data_buf[block_pos]
+                if next_data.shape == (1,):
+                    next_data = bytes(next_data[0])
+                    #logger.debug("Going from singleton to string: '{}...'".format(next_data[::-1][:50]))
+                else:
+                    #logger.debug("H5 record shape: {}".format(next_data.shape))
+                    pass
+
+                # take label out of container if singleton
+                next_label = labels_buf[block_pos]
+                if next_label.shape == (1,):
+                    next_label = next_label[0]
+                    #logger.debug("Going from singleton to numeric type: {}".format(type(next_label)))
+                    #logger.debug("Shape: {}".format(next_label.shape))
+                else:
+                    #logger.debug("H5 record shape: {}".format(next_label.shape))
+                    pass
+                yield (next_data, next_label)
+
+def split_probabilities(splits):
+    ''' Turns a list of n-1 probabilities (0-1) into the
+    probabilities of landing in each of n bins '''
+    assert np.sum(splits) < 1.0
+    return np.append(splits, 1 - np.sum(splits))
 
 def pick_splits(splits):
     ''' Pick a bin from a list of n-1 probabilities (0-1)
     for landing in n bins. Used for splitting data.'''
-    # avoid changing splits argument in place
-    splits = splits[:]
-    assert np.sum(splits) < 1.0
-    splits.append(1 - np.sum(splits))
-    # generate the strictly increasing cutoffs for each split from >0 to 1 
-    cum_cutoffs = np.cumsum(splits)
-    logger = logging.getLogger(__name__)
-    logger.debug(cum_cutoffs)
-    # roll the die
-    pick_num = np.random.random()
-    logger.debug(pick_num)
-    bin_num = 0
-    for cutoff in cum_cutoffs:
-        if pick_num < cutoff:
-            return bin_num
-        bin_num += 1
+    return int(np.random.choice(len(splits) + 1, p=split_probabilities(splits)))
+
+def _draw_bins(rng, probs, block_size=1024):
+    ''' Endlessly yields bin indices drawn with probabilities probs
+    from the RandomState rng, drawing block_size of them at a time '''
+    while True:
+        for bin_id in rng.choice(len(probs), size=block_size, p=probs):
+            yield bin_id
     
         
-def write_batch_to_h5(splits, h5_file, data_sizes, new_data, new_labels):
+# upper bound on the size of one chunk of split_data's datasets: HDF5's
+# default chunk cache holds 1 MB per dataset, and every chunk a shuffled
+# read touches must fit in it
+_MAX_CHUNK_NBYTES = 1024 * 1024
+
+def _slice_chunks(batch):
+    ''' Chunk shape for a split_data dataset of records like those of
+    batch: one batch, or as many records as fit in _MAX_CHUNK_NBYTES '''
+    row_nbytes = batch.dtype.itemsize * int(np.prod(batch.shape[1:]))
+    nr_rows = min(batch.shape[0], max(1, _MAX_CHUNK_NBYTES // max(row_nbytes, 1)))
+    return (nr_rows,) + batch.shape[1:]
+
+def _slice_compression(compression, batch):
+    ''' Resolves split_data's compression argument for a dataset of
+    records like those of batch '''
+    if compression == "auto":
+        return "lzf" if batch.shape[1:] == (1,) else None
+    return compression
+
+def write_batch_to_h5(bin_id, h5_file, data_sizes, new_data, new_labels):
     """ Takes some information about a minibatch of data and 
         writes it into the given HDF5 file
 
         @Arguments
-            splits -- akin to split data, a series of probabilities
-                that sum to less than one. The nth probability is the 
-                probability of landing in the nth bin. 1-sum(splits) is 
-                the probability of landing in the last bin
+            bin_id -- index of the bin to write the minibatch to
             h5_file -- an h5py File object, representing an HDF5
                 file open for writing
             data_sizes -- a list of length len(splits) + 1 for
-                each bin of data. Values are the counts of data in each bin
+                each bin of data. Values are the counts of data in each bin.
+                Datasets are grown ahead of these counts, so they may hold
+                more (unwritten) rows until trimmed
             new_data -- a numpy array with a new minibatch
             new_labels -- a numpy array with a new set of labels
     """
@@ -337,15 +880,16 @@ def write_batch_to_h5(splits, h5_file, data_sizes, new_data, new_labels):
     assert new_data.shape[0] == new_labels.shape[0]
     # make a copy of data_sizes
     data_sizes = data_sizes[:]
-    # pick which bin to assign data to
-    bin_id = pick_splits(splits)
     bin_name = str(bin_id)
     # get slice indexes
     start_i = data_sizes[bin_id]
     end_i = start_i + new_data.shape[0]
-    # resize HDF5 datasets
-    h5_file["data_" + bin_name].resize(end_i, 0)
-    h5_file["labels_" + bin_name].resize(end_i, 0)
+    # resize HDF5 datasets, doubling their capacity when it runs out
+    # so that they are resized O(log n) times rather than every batch
+    for dset_name in ("data_" + bin_name, "labels_" + bin_name):
+        dset = h5_file[dset_name]
+        if end_i > dset.shape[0]:
+            dset.resize(max(end_i, 2 * dset.shape[0]), 0)
     # write data
     h5_file["data_" + bin_name][start_i:end_i, ...] = new_data
     h5_file["labels_" + bin_name][start_i:end_i, ...] = new_labels
@@ -358,7 +902,9 @@ def split_data(batch_iterator,
                splits = [0.8],
                rng_seed=None,
                overwrite_previous=False,
-               shuffle=False):
+               shuffle=False,
+               write_coalesce=16,
+               compression="auto"):
     ''' Splits data into slices and returns a list of
         H5Iterators over each slice. Slice size is configurable.
         Probabilistic, so may not produce exactly the expected bin sizes, 
@@ -376,10 +922,19 @@ def split_data(batch_iterator,
                 list of floats indicating how to split the data. The data will
                 be split into len(splits) + 1 slices, with the final slice 
                 having 1-sum(splits) of the data.
-            rng_seed -- random number generator seed
+            rng_seed -- seed for the random number generator that assigns
+                batches to slices. The global numpy generator is left alone
             overwrite_previous -- if h5_path is already a readable file,
                 overwrite it?
             shuffle -- should the iterators return records in shuffled order?
+            write_coalesce -- how many batches to gather for a slice before
+                writing them to the HDF5 file in one go
+            compression -- compression filter for the slices' HDF5
+                datasets, e.g. "lzf", or None for none. The default, "auto",
+                uses lzf only for singleton records (such as the texts
+                split_and_batch writes); wider records are left
+                uncompressed, since reading them in shuffled order means
+                decompressing a whole chunk for every record
             
         @Returns
             A 2-tuple:
@@ -392,39 +947,90 @@ def split_data(batch_iterator,
 
     # How many chunks to split into?
     nb_slices = len(splits) + 1
-    np.random.seed(rng_seed)
+    # probability of each batch landing in each slice, and where they land
+    split_probs = split_probabilities(splits)
+    bin_draws = _draw_bins(np.random.RandomState(rng_seed), split_probs)
     bin_sizes = [0]*nb_slices
     initialized_file=False
+    # per-slice staging arrays that batches are gathered into before being
+    # written to HDF5 write_coalesce batches at a time, and their fill counts
+    staged_data = [None]*nb_slices
+    staged_labels = [None]*nb_slices
+    nr_staged = [0]*nb_slices
                     
     # Check for HDF5 file already on disk
     if overwrite_previous or not os.path.isfile(h5_path):
+        # iterators over the previous contents are invalidated
+        close_h5_files(h5_path)
         with h5py.File(h5_path, "w") as  h5_file:
         
-            for new_data, new_labels in batch_iterator:
-                # use the first batch to diagnose dimensions and dtypes
-                if not initialized_file:
-                    # create two datasets (features and labels) for each slice
-                    bin_names = [str(bin_i) for bin_i in range(nb_slices)]
-                    for bin_name in bin_names:
-                        h5_file.create_dataset(name="data_" + bin_name,
-                                           shape=new_data.shape,
-                                           maxshape=(None,) +  new_data.shape[1:],
-                                           dtype=new_data.dtype)
-                        h5_file.create_dataset(name="labels_" + bin_name,
-                                           shape=new_labels.shape,
-                                           maxshape=(None,) +  new_labels.shape[1:],
-                                           dtype=new_labels.dtype)
-                    initialized_file=True
-                # loop other batches into dataset
-                bin_sizes = write_batch_to_h5(splits, h5_file, bin_sizes, new_data, new_labels)
+            try:
+                for new_data, new_labels in batch_iterator:
+                    # use the first batch to diagnose dimensions and dtypes
+                    if not initialized_file:
+                        # create two datasets (features and labels) for each slice,
+                        # chunked by batch (or less, for wide records)
+                        bin_names = [str(bin_i) for bin_i in range(nb_slices)]
+                        for bin_name in bin_names:
+                            for dset_name, new_values in (("data_" + bin_name, new_data),
+                                                          ("labels_" + bin_name, new_labels)):
+                                dset_compression = _slice_compression(compression, new_values)
+                                h5_file.create_dataset(name=dset_name,
+                                                   shape=new_values.shape,
+                                                   maxshape=(None,) +  new_values.shape[1:],
+                                                   chunks=_slice_chunks(new_values),
+                                                   compression=dset_compression,
+                                                   shuffle=dset_compression is not None,
+                                                   dtype=new_values.dtype)
+                        initialized_file=True
+                        if write_coalesce > 1:
+                            for bin_i in range(nb_slices):
+                                staged_data[bin_i] = np.empty(
+                                    (write_coalesce * new_data.shape[0],) + new_data.shape[1:],
+                                    new_data.dtype)
+                                staged_labels[bin_i] = np.empty(
+                                    (write_coalesce * new_labels.shape[0],) + new_labels.shape[1:],
+                                    new_labels.dtype)
+                    # loop other batches into dataset; batches are copied or written
+                    # out before the next is requested, so pooled buffers are safe
+                    bin_id = next(bin_draws)
+                    nr_new = new_data.shape[0]
+                    if staged_data[bin_id] is None or nr_new > staged_data[bin_id].shape[0]:
+                        bin_sizes = write_batch_to_h5(bin_id, h5_file, bin_sizes, new_data, new_labels)
+                        continue
+                    # flush the slice's staged batches if this one does not fit
+                    if nr_staged[bin_id] + nr_new > staged_data[bin_id].shape[0]:
+                        bin_sizes = write_batch_to_h5(bin_id, h5_file, bin_sizes,
+                            staged_data[bin_id][:nr_staged[bin_id]],
+                            staged_labels[bin_id][:nr_staged[bin_id]])
+                        nr_staged[bin_id] = 0
+                    staged_data[bin_id][nr_staged[bin_id]:nr_staged[bin_id] + nr_new] = new_data
+                    staged_labels[bin_id][nr_staged[bin_id]:nr_staged[bin_id] + nr_new] = new_labels
+                    nr_staged[bin_id] += nr_new
+            finally:
+                # even if batch_iterator raises, write out what is left
+                # staged and trim the datasets, so that the file does not
+                # claim unwritten rows as records
+                try:
+                    for bin_i in range(nb_slices):
+                        if nr_staged[bin_i] > 0:
+                            bin_sizes = write_batch_to_h5(bin_i, h5_file, bin_sizes,
+                                staged_data[bin_i][:nr_staged[bin_i]],
+                                staged_labels[bin_i][:nr_staged[bin_i]])
+                finally:
+                    # trim datasets down to the records actually written
+                    if initialized_file:
+                        for bin_i, bin_size in enumerate(bin_sizes):
+                            h5_file["data_" + str(bin_i)].resize(bin_size, 0)
+                            h5_file["labels_" + str(bin_i)].resize(bin_size, 0)
     else:
         # fill in counts of each data slice
-        with h5py.File(h5_path, "r") as f:
-            for bin_i in range(nb_slices):
-                try:
-                    bin_sizes[bin_i] = f['data_' + str(bin_i)].shape[0]
-                except KeyError:
-                    pass
+        f = _open_h5(h5_path)
+        for bin_i in range(nb_slices):
+            try:
+                bin_sizes[bin_i] = f['data_' + str(bin_i)].shape[0]
+            except KeyError:
+                pass
             
     # now to return iterators over the HDF5 datasets for each slice
     # these can, in turn, be batched with batch_data (auughhh)
@@ -443,15 +1049,27 @@ def split_and_batch(data_loader,
                     doclength,
                     h5_path,
                     rng_seed=888,
-                    normalizer_fun=data_utils.normalize,
+                    normalizer_fun=data_utils.normalize_or_none,
                     transformer_fun=data_utils.to_one_hot,
                     balance_labels=False,
-                    max_records=None):
+                    max_records=None,
+                    cache_path=None):
     """
     Convenience wrapper for most common splitting and batching
     workflow in neon. Splits data to an HDF5 path, if it does not already exist,
     and then returns functions for getting geerators over the datasets
     (gets around limitations of input to neon_utils.DiskDataIterator)
+
+    If cache_path is given, the first complete pass over each dataset
+    also writes the transformed records to an HDF5 file next to
+    cache_path, and later passes read them back from there instead of
+    transforming them again. The cache file names include a hash of
+    the transformer and of the split file, so stale caches are not
+    picked up. Cached records are stored uncompressed and read back a
+    whole batch at a time, so shuffled passes over the cache shuffle the
+    order of batches but not which records are batched together. One-hot
+    records are much larger than the texts they encode, so the cache
+    takes about batch_size * doclength * 67 bytes per batch on disk.
     """
     data_batches = batch_data(data_loader, batch_size,
         normalizer_fun=normalizer_fun,
@@ -461,22 +1079,133 @@ def split_and_batch(data_loader,
         nlabels=2)
     (_, _), (train_size, test_size) = split_data(data_batches, 
             h5_path, overwrite_previous=False, rng_seed=rng_seed)
+    if cache_path is not None:
+        cache_key = _cache_key(transformer_fun, doclength, h5_path)
     def train_batcher():
+        if cache_path is not None:
+            cache_file = _cache_file_path(cache_path, cache_key, 0)
+            if os.path.isfile(cache_file):
+                return _read_cached_batches(cache_file, 0, batch_size, shuffle=True)
         (a,b),(a_size,b_size)=split_data(None, h5_path=h5_path, overwrite_previous=False, shuffle=True)
-        return batch_data(a,
+        batches = batch_data(a,
             normalizer_fun=lambda x: x,
             transformer_fun=transformer_fun,
             flatten=True,
             batch_size=batch_size)
+        if cache_path is not None:
+            batches = _write_cached_batches(batches, cache_file, 0,
+                                            train_size // batch_size)
+        return batches
     def test_batcher():
+        if cache_path is not None:
+            cache_file = _cache_file_path(cache_path, cache_key, 1)
+            if os.path.isfile(cache_file):
+                return _read_cached_batches(cache_file, 1, batch_size, shuffle=False)
         (a,b),(a_size,b_size)=split_data(None, h5_path, overwrite_previous=False,shuffle=False)
-        return batch_data(b,
+        batches = batch_data(b,
             normalizer_fun=lambda x: x,
             transformer_fun=transformer_fun,
             flatten=True,
             batch_size=batch_size)
+        if cache_path is not None:
+            batches = _write_cached_batches(batches, cache_file, 1,
+                                            test_size // batch_size)
+        return batches
 
     return (train_batcher, test_batcher), (train_size, test_size)               
+
+def _cache_key(transformer_fun, doclength, h5_path):
+    ''' Short hash identifying the transformed records that
+    split_and_batch would cache for these arguments '''
+    code = getattr(transformer_fun, "__code__", None)
+    key = (getattr(transformer_fun, "__module__", None),
+           getattr(transformer_fun, "__name__", repr(transformer_fun)),
+           code.co_code if code is not None else None,
+           doclength,
+           os.path.abspath(h5_path),
+           os.path.getmtime(h5_path))
+    return hashlib.md5(repr(key)).hexdigest()[:8]
+
+def _cache_file_path(cache_path, cache_key, bin_i):
+    ''' Path of the cache file for slice bin_i '''
+    root, ext = os.path.splitext(cache_path)
+    return "{}.{}.{}{}".format(root, cache_key, bin_i, ext)
+
+def _write_cached_batches(batches, cache_file, bin_i, nr_batches):
+    ''' Yields from batches, also writing each batch to the datasets
+    data_onehot_[bin_i] and labels_[bin_i] of cache_file. Batches are written
+    to a temporary file that is only moved to cache_file once a complete
+    pass has been written: nr_batches batches, or all of batches if it
+    runs out sooner. Consumers such as neon_iterator.DiskDataIterator take
+    exactly as many batches as they expect, without exhausting batches.
+    An interrupted pass is not mistaken for a cache '''
+    bin_name = str(bin_i)
+    partial_file = cache_file + ".partial"
+    nr_written = 0
+    complete = False
+    h5_file = h5py.File(partial_file, "w")
+    try:
+        for batch_i, (new_data, new_labels) in enumerate(batches):
+            if not complete:
+                if batch_i == 0:
+                    # one uncompressed chunk per batch, so that
+                    # _read_cached_batches reads each batch in one go
+                    h5_file.create_dataset(name="data_onehot_" + bin_name,
+                                           shape=(0,) + new_data.shape[1:],
+                                           maxshape=(None,) + new_data.shape[1:],
+                                           chunks=new_data.shape,
+                                           dtype=new_data.dtype)
+                    h5_file.create_dataset(name="labels_" + bin_name,
+                                           shape=(0,) + new_labels.shape[1:],
+                                           maxshape=(None,) + new_labels.shape[1:],
+                                           chunks=new_labels.shape,
+                                           dtype=new_labels.dtype)
+                end_i = nr_written + new_data.shape[0]
+                for dset_name, new_values in (("data_onehot_" + bin_name, new_data),
+                                              ("labels_" + bin_name, new_labels)):
+                    h5_file[dset_name].resize(end_i, 0)
+                    h5_file[dset_name][nr_written:end_i, ...] = new_values
+                nr_written = end_i
+                if batch_i + 1 == nr_batches:
+                    _finish_cache_file(h5_file, partial_file, cache_file)
+                    complete = True
+            yield new_data, new_labels
+        if not complete and nr_written > 0:
+            _finish_cache_file(h5_file, partial_file, cache_file)
+            complete = True
+    finally:
+        if not complete:
+            h5_file.close()
+            os.remove(partial_file)
+
+def _finish_cache_file(h5_file, partial_file, cache_file):
+    ''' Closes h5_file, written by _write_cached_batches to partial_file,
+    and moves it to cache_file '''
+    h5_file.close()
+    close_h5_files(cache_file)
+    os.rename(partial_file, cache_file)
+
+def _read_cached_batches(cache_file, bin_i, batch_size, shuffle):
+    ''' Yields the batches cached by _write_cached_batches, in shuffled
+    order if shuffle is true. Each batch is read from the file in one go,
+    so records stay in the batches they were cached in. Like batch_data,
+    yields read-only views onto reused buffers, each valid until the batch
+    after next is requested '''
+    bin_name = str(bin_i)
+    h5_file = _open_h5(cache_file)
+    data = h5_file["data_onehot_" + bin_name]
+    labels = h5_file["labels_" + bin_name]
+    batch_order = np.arange(data.shape[0] // batch_size)
+    if shuffle:
+        np.random.shuffle(batch_order)
+    docs_pool = [np.empty((batch_size,) + data.shape[1:], data.dtype) for _ in range(2)]
+    labels_pool = [np.empty((batch_size,) + labels.shape[1:], labels.dtype) for _ in range(2)]
+    for pool_idx, batch_i in enumerate(batch_order):
+        pool_idx %= 2
+        rows = np.s_[batch_i * batch_size:(batch_i + 1) * batch_size]
+        data.read_direct(docs_pool[pool_idx], rows)
+        labels.read_direct(labels_pool[pool_idx], rows)
+        yield _readonly_view(docs_pool[pool_idx]), _readonly_view(labels_pool[pool_idx])
                 
 if __name__=="__main__":
     # some demo code
@@ -238,7 +238,8 @@ def tokenize(txt):
 def normalize(txt, vocab=None, replace_char=' ',
                 min_length=100, max_length=1014, pad_out=True, 
                 to_lower=True, reverse = True, 
-                truncate_left=False, encoding="latin1"):
+                truncate_left=False, encoding="latin1",
+                none_if_rejected=False):
     ''' Takes a single string object and truncates it to max_length,
     raises an exception if its length does not exceed min_length, and
     performs case normalization if to_lower is True. Optionally
@@ -266,8 +267,13 @@ def normalize(txt, vocab=None, replace_char=' ',
             
         encoding -- if not None, encode txt using this encoding
 
+        none_if_rejected -- if True, return None instead of raising
+            when txt is rejected. Raising and catching an exception for
+            every rejected record is slow when there are many of them
+
     @Returns:
-        Normalized version of txt
+        Normalized version of txt, or None if it is rejected and
+        none_if_rejected is True
 
     @Raises:
         DataException, TextTooShortException
@@ -278,6 +284,8 @@ def normalize(txt, vocab=None, replace_char=' ',
 
     # reject txt if too short
     if txt_len < min_length:
+        if none_if_rejected:
+            return None
         raise TextTooShortException("Too short: {}".format(txt_len))
     # truncate if too long
     if truncate_left:
@@ -301,11 +309,25 @@ def normalize(txt, vocab=None, replace_char=' ',
         txt = replace_char * (max_length - txt_len) + txt
     return txt
 
+def normalize_or_none(txt, **kwargs):
+    ''' Same as normalize, but returns None for rejected texts
+    rather than raising TextTooShortException '''
+    return normalize(txt, none_if_rejected=True, **kwargs)
+
 zhang_lecun_vocab=list("abcdefghijklmnopqrstuvwxyz0123456789,;.!?:'\"/|_@#$%^&*~`+-=<>()[]{}")
 zhang_lecun_vocab_hash = {b: a for a, b in enumerate(zhang_lecun_vocab)}
+# byte value -> vocab index lookup table, -1 for out-of-vocab bytes
+zhang_lecun_vocab_lut = np.full(256, -1, dtype=np.int8)
+zhang_lecun_vocab_lut[[ord(c) for c in zhang_lecun_vocab]] = np.arange(len(zhang_lecun_vocab))
 def to_one_hot(txt, vocab=zhang_lecun_vocab, vocab_hash=zhang_lecun_vocab_hash):
     vocab_size = len(vocab)
     one_hot_vec = np.zeros((vocab_size, len(txt)))
+    # byte strings in the default vocab can be encoded with one scatter
+    if vocab is zhang_lecun_vocab and isinstance(txt, str):
+        vocab_idx = zhang_lecun_vocab_lut[np.frombuffer(txt, dtype=np.uint8)]
+        cols = np.nonzero(vocab_idx >= 0)[0]
+        one_hot_vec[vocab_idx[cols], cols] = 1
+        return one_hot_vec
     # run through txt and "switch on" relevant positions in one-hot vector
     for idx, char in enumerate(txt):
         try:
@@ -316,6 +338,32 @@ def to_one_hot(txt, vocab=zhang_lecun_vocab, vocab_hash=zhang_lecun_vocab_hash):
             pass
     return one_hot_vec
 
+def to_one_hot_batch(byte_rows, out=None, lut=zhang_lecun_vocab_lut):
+    ''' One-hot encodes a batch of byte strings with a single fancy-indexed
+    write, rather than character by character
+
+    @Arguments:
+        byte_rows -- uint8 array of shape (batch, doclength) holding
+            the bytes of each text; pad short texts with an
+            out-of-vocab byte such as 0
+
+        out -- if not None, a zeroed int8 array of shape
+            (batch, vocab size, doclength) to encode into
+
+        lut -- 256-entry array mapping each byte to its index in the
+            vocab, or -1 if it is out of vocab
+
+    @Returns:
+        int8 array of shape (batch, vocab size, doclength)
+    '''
+    vocab_idx = lut[byte_rows]
+    rows, cols = np.nonzero(vocab_idx >= 0)
+    if out is None:
+        out = np.zeros((byte_rows.shape[0], int(lut.max()) + 1, byte_rows.shape[1]),
+                       dtype=np.int8)
+    out[rows, vocab_idx[rows, cols], cols] = 1
+    return out
+
 def from_one_hot(oh, vocab=zhang_lecun_vocab):
     vocab_hash = { a: b for a, b in enumerate(vocab) }
     txt = []
@@ -0,0 +1,225 @@
+import os
+import sys
+import shutil
+import functools
+import itertools
+import subprocess
+import tempfile
+import time
+current_path = os.path.dirname(os.path.abspath(__file__))
+datasets_path = os.path.dirname(current_path)
+sys.path.insert(0, datasets_path)
+
+from nose.tools import raises
+import numpy as np
+import h5py
+
+import data_utils
+import batch_data
+
+
+def make_records(nr_records, seed=0):
+    ''' (text, label) records with labels 0 and 1 in unequal numbers,
+    including some texts too short for data_utils.normalize '''
+    rng = np.random.RandomState(seed)
+    records = []
+    for i in range(nr_records):
+        txt_len = rng.randint(80, 200)
+        txt = "".join(chr(c) for c in rng.randint(32, 127, txt_len))
+        records.append((txt, int(rng.rand() < 0.3)))
+    return records
+
+def reference_batches(records, batch_size, normalizer_fun, transformer_fun,
+                      balance_labels=False, nlabels=None, max_records=None):
+    ''' Batches records the way batch_data did before it batched into
+    pooled buffers: accumulating lists of transformed records, and
+    taking batch_size / nlabels of each label in turn when balanced '''
+    docs = {}
+    docs_labels = []
+    nr_yielded = 0
+    for doc_text, label in records:
+        try:
+            transformed_doc = transformer_fun(normalizer_fun(doc_text))
+        except data_utils.DataException:
+            continue
+        if balance_labels:
+            docs.setdefault(label, []).append(transformed_doc)
+            ready = len(docs) == nlabels and \
+                all(len(label_docs) >= batch_size // nlabels for label_docs in docs.values())
+        else:
+            docs_labels.append((transformed_doc, label))
+            ready = len(docs_labels) >= batch_size
+        if not ready:
+            continue
+        if max_records is not None and nr_yielded + batch_size > max_records:
+            return
+        if balance_labels:
+            batched = [(docs[next_label].pop(0), next_label)
+                       for _ in range(batch_size // nlabels)
+                       for next_label in sorted(docs)]
+        else:
+            batched, docs_labels = docs_labels[:batch_size], docs_labels[batch_size:]
+        docs_np = np.array([doc for doc, _ in batched]).reshape((batch_size, -1))
+        labels_np = np.array([label for _, label in batched]).reshape((batch_size, -1))
+        nr_yielded += batch_size
+        yield docs_np, labels_np
+
+def copied_batches(batches):
+    ''' batch_data's batches are reused buffers, so copy them to keep them '''
+    return [(np.array(docs), np.array(labels)) for docs, labels in batches]
+
+def test_batches_match_reference():
+    records = make_records(1500)
+    normalizer_fun = functools.partial(data_utils.normalize, max_length=150)
+    for balance_labels in (False, True):
+        for transformer_fun in (None, data_utils.to_one_hot):
+            for prefetch in (0, 2):
+                expected = list(reference_batches(records, 16, normalizer_fun,
+                    transformer_fun or np.array, balance_labels=balance_labels,
+                    nlabels=2, max_records=1200))
+                actual = copied_batches(batch_data.batch_data(records, 16,
+                    normalizer_fun=normalizer_fun, transformer_fun=transformer_fun,
+                    balance_labels=balance_labels, nlabels=2, max_records=1200,
+                    prefetch=prefetch))
+                assert len(expected) > 10
+                assert len(actual) == len(expected)
+                for (docs, labels), (expected_docs, expected_labels) in zip(actual, expected):
+                    assert docs.shape == expected_docs.shape
+                    assert (docs == expected_docs).all()
+                    assert labels.dtype == expected_labels.dtype
+                    assert (labels == expected_labels).all()
+
+def test_workers_keep_h5_array_records():
+    # each record of the file is filled with its own label, so rows
+    # that were overwritten before reaching a worker stand out
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        h5_path = os.path.join(tmp_dir, "arrays.h5")
+        nr_records = 4096
+        with h5py.File(h5_path, "w") as h5_file:
+            h5_file["data"] = np.repeat(np.arange(nr_records, dtype=np.int32)[:, None],
+                                        500, axis=1)
+            h5_file["labels"] = np.arange(nr_records, dtype=np.int64)[:, None]
+        records = batch_data.H5Iterator(h5_path, "data", "labels", block_size=64)
+        labels_seen = []
+        for docs, labels in batch_data.batch_data(records, 32, num_workers=8):
+            assert (docs == labels).all()
+            labels_seen.extend(labels[:, 0])
+        assert sorted(labels_seen) == range(nr_records)
+        records.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def fake_batches(nr_batches, batch_size=8):
+    for batch_i in range(nr_batches):
+        yield (np.full((batch_size, 20), batch_i, np.int8),
+               np.full((batch_size, 1), batch_i, np.int64))
+
+def test_cache_written_after_nr_batches():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache_file = os.path.join(tmp_dir, "cache.0.h5")
+        # the consumer takes the expected number of batches and no more,
+        # like neon_iterator.DiskDataIterator
+        batches = batch_data._write_cached_batches(fake_batches(5), cache_file, 0, 3)
+        taken = list(itertools.islice(batches, 3))
+        assert os.path.isfile(cache_file)
+        assert not os.path.exists(cache_file + ".partial")
+        cached = copied_batches(batch_data._read_cached_batches(cache_file, 0, 8, shuffle=False))
+        assert len(cached) == 3
+        for (docs, labels), (cached_docs, cached_labels) in zip(taken, cached):
+            assert (docs == cached_docs).all()
+            assert (labels == cached_labels).all()
+        batch_data.close_h5_files(cache_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_interrupted_cache_is_discarded():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache_file = os.path.join(tmp_dir, "cache.0.h5")
+        batches = batch_data._write_cached_batches(fake_batches(5), cache_file, 0, 5)
+        list(itertools.islice(batches, 2))
+        batches.close()
+        assert os.listdir(tmp_dir) == []
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_split_data_trims_after_failure():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        h5_path = os.path.join(tmp_dir, "split.h5")
+        def failing_batches():
+            for batch in fake_batches(21):
+                yield batch
+            raise ValueError("batching failed")
+        try:
+            batch_data.split_data(failing_batches(), h5_path, rng_seed=0, write_coalesce=4)
+        except ValueError:
+            pass
+        else:
+            assert False, "split_data should re-raise the iterator's exception"
+        # every batch yielded before the failure made it into the file,
+        # and no unwritten rows did
+        batch_data.close_h5_files(h5_path)
+        with h5py.File(h5_path, "r") as h5_file:
+            batch_ids = np.concatenate([h5_file["labels_0"][:, 0], h5_file["labels_1"][:, 0]])
+            assert sorted(batch_ids) == sorted(range(21) * 8)
+            assert h5_file["data_0"].shape[0] == h5_file["labels_0"].shape[0]
+            assert h5_file["data_1"].shape[0] == h5_file["labels_1"].shape[0]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_split_data_chunks():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        h5_path = os.path.join(tmp_dir, "split.h5")
+        wide_batches = ((np.zeros((128, 67, 300), np.int8), np.zeros((128, 1), np.int64))
+                        for _ in range(4))
+        batch_data.split_data(wide_batches, h5_path, rng_seed=0)
+        batch_data.close_h5_files(h5_path)
+        with h5py.File(h5_path, "r") as h5_file:
+            data = h5_file["data_0"]
+            chunk_nbytes = np.prod(data.chunks) * data.dtype.itemsize
+            assert chunk_nbytes <= batch_data._MAX_CHUNK_NBYTES
+            assert data.compression is None
+            assert h5_file["labels_0"].chunks == (128, 1)
+            assert h5_file["labels_0"].compression == "lzf"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+@raises(ValueError)
+def test_prefetch_reraises_loader_exceptions():
+    def failing_loader():
+        for record in make_records(100):
+            yield record
+        raise ValueError("loader failed")
+    for _ in batch_data.batch_data(failing_loader(), 8, prefetch=2):
+        pass
+
+def test_abandoned_prefetch_exits_cleanly():
+    # a consumer that stops early leaves the prefetch thread blocked on
+    # a full queue, with a worker pool running; the interpreter should
+    # still exit, promptly and without tracebacks
+    script = "\n".join([
+        "import sys",
+        "sys.path.insert(0, {!r})".format(datasets_path),
+        "import data_utils",
+        "import batch_data",
+        "records = [('abc' * 40 + str(i), i % 2) for i in range(20000)]",
+        "batches = batch_data.batch_data(records, normalizer_fun=data_utils.normalize_or_none,",
+        "    transformer_fun=data_utils.to_one_hot, num_workers=2)",
+        "next(batches)",
+    ])
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen([sys.executable, "-c", script], stderr=stderr)
+        deadline = time.time() + 60
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if process.poll() is None:
+            process.kill()
+            assert False, "interpreter did not exit"
+        stderr.seek(0)
+        errors = stderr.read()
+    assert process.returncode == 0
+    assert errors.strip() == "", errors
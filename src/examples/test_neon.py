@@ -177,7 +177,7 @@ def do_model(dataset_name, working_dir, results_path, data_path, hdf5_path,
         max_length=1014,
         sequence_length=None,
         rng_seed=888,
-        normalizer_fun=data_utils.normalize,
+        normalizer_fun=data_utils.normalize_or_none,
         transformer_fun=data_utils.to_one_hot,
         gpu_id=1,
         nframes=256,
@@ -311,14 +311,14 @@ def do_model(dataset_name, working_dir, results_path, data_path, hdf5_path,
               num_epochs=nr_epochs, cost=cost, callbacks=callbacks)
 
 def normalize_tweet(txt):
-    return data_utils.normalize(txt, min_length=70, max_length=150)
+    return data_utils.normalize_or_none(txt, min_length=70, max_length=150)
 
 def transform_for_vectors(txt):
     txt = data_utils.tokenize(txt[::-1])
     return txt
 
 def normalize_imdb(txt):
-    return data_utils.normalize(txt, encoding=None)
+    return data_utils.normalize_or_none(txt, encoding=None)
 
 def reverse(txt):
     return txt[::-1]
@@ -400,10 +400,10 @@ def main():
             'normalizer_fun'    : normalize_imdb,
             },
         'amazon'            : {
-            'normalizer_fun'    : data_utils.normalize, 
+            'normalizer_fun'    : data_utils.normalize_or_none, 
             },
         'open_weiboscope'   : {
-            'normalizer_fun'    : data_utils.normalize,
+            'normalizer_fun'    : data_utils.normalize_or_none,
             'balance_labels'    : True,
             'max_records'       : 2e6,
             },